@@ -11,11 +11,17 @@
 
 import aiohttp
 import asyncio
+import copy
+import functools
 import hashlib
+import json
+import os
 import time
 import random
-from typing import List, Tuple, Type, Any, Optional, Dict, Set
-from datetime import datetime, time as dt_time
+from dataclasses import dataclass
+from typing import List, Tuple, Type, Any, Optional, Dict, Set, FrozenSet, NamedTuple
+from datetime import date, datetime, timedelta, time as dt_time
+from peewee import SqliteDatabase, chunked, fn
 from src.plugin_system import (
     BasePlugin,
     BaseCommand,
@@ -32,12 +38,260 @@ from src.config.config import global_config
 from src.llm_models.utils_model import LLMRequest
 from src.config.config import model_config
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+try:
+    import xxhash
+
+    def _content_digest(key: str) -> int:
+        return xxhash.xxh3_64_intdigest(key.encode())
+except ImportError:  # xxhash 为可选依赖，未安装时回退到 md5（取前 64 位）
+    def _content_digest(key: str) -> int:
+        digest = hashlib.md5(key.encode(), usedforsecurity=False).digest()
+        return int.from_bytes(digest[:8], "big")
+
 logger = get_logger("MaiShangHao")
 
 OFFLINE_MESSAGE_START = "【离线消息开始】以下是你下线期间收到的消息："
 OFFLINE_MESSAGE_END = "【离线消息结束】以上是你下线期间收到的消息。"
 
-DREAM_STATE = {"is_dreaming": False, "dream_groups": set()}
+DREAM_STATE = {"is_dreaming": False, "dream_groups": set(), "dream_groups_frozen": frozenset()}
+
+CONFIG_FLUSH_DELAY = 0.5
+DREAM_IDLE_MAX_SLEEP = 3600
+DREAM_ERROR_TRACEBACK_INTERVAL = 300
+DREAM_ERROR_MAX_BACKOFF = 3600
+
+_CONFIG_CACHE: Optional[dict] = None
+_CONFIG_VERSION = 0
+_CONFIG_LOCK = asyncio.Lock()
+_CONFIG_FLUSH_HANDLE: Optional[asyncio.TimerHandle] = None
+_CONFIG_FLUSH_TASK: Optional[asyncio.Task] = None
+_DREAM_CONFIG_SNAPSHOT: Optional[Tuple[int, "DreamConfig"]] = None
+
+DREAM_COMMAND_PATTERN = r"^/dream\s+(?P<action>help|reset|status|config|enable|disable|set|test)\s*(?P<params>.*)$"
+
+NAPCAT_MAX_CONCURRENCY = 8
+PLANNER_MAX_CONCURRENCY = 4
+SQLITE_MAX_VARIABLES = 999
+SQLITE_IN_CHUNK = 500
+CONTENT_HASH_PREFIX = 100
+
+_SHARED_SESSION: Optional[aiohttp.ClientSession] = None
+_NAPCAT_SEMAPHORE = asyncio.Semaphore(NAPCAT_MAX_CONCURRENCY)
+
+
+async def get_shared_session() -> aiohttp.ClientSession:
+    """获取全局共享的 aiohttp 会话
+
+    所有 NapCatAPI 实例共用同一个连接池，复用 keep-alive 连接，
+    避免每次同步/做梦都重新建立 TCP 连接。
+    """
+    global _SHARED_SESSION
+    if _SHARED_SESSION is None or _SHARED_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=50,
+            limit_per_host=10,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
+        _SHARED_SESSION = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    return _SHARED_SESSION
+
+
+async def close_shared_session():
+    """关闭全局共享的 aiohttp 会话（插件停止时调用）"""
+    global _SHARED_SESSION
+    if _SHARED_SESSION is not None and not _SHARED_SESSION.closed:
+        await _SHARED_SESSION.close()
+    _SHARED_SESSION = None
+
+
+@functools.lru_cache(maxsize=256)
+def _stream_id(platform: str, group_id: str) -> str:
+    """生成聊天流ID（与 MaiBot 核心逻辑一致），群号集合很小，结果直接缓存"""
+    return hashlib.md5(f"{platform}_{group_id}".encode(), usedforsecurity=False).hexdigest()
+
+
+@functools.lru_cache(maxsize=32)
+def _messages_insert_sql(columns: Tuple[str, ...], n_rows: int) -> str:
+    """生成 Messages 表的多行参数化 INSERT 语句，按 (列, 行数) 缓存"""
+    database = Messages._meta.database
+    open_q, close_q = database.quote
+    table = f"{open_q}{Messages._meta.table_name}{close_q}"
+    column_sql = ", ".join(
+        f"{open_q}{Messages._meta.fields[c].column_name}{close_q}" for c in columns
+    )
+    row_sql = "(" + ", ".join([database.param] * len(columns)) + ")"
+    return f"INSERT INTO {table} ({column_sql}) VALUES " + ", ".join([row_sql] * n_rows)
+
+
+def _seconds_until_next_window(
+    parsed_windows: List[Tuple[dt_time, dt_time]], now: datetime
+) -> Optional[float]:
+    """计算距离下一个梦境时间段开始还有多少秒，没有有效时间段时返回 None"""
+    deltas = []
+    for start_time, _ in parsed_windows:
+        start_dt = datetime.combine(now.date(), start_time)
+        if start_dt <= now:
+            start_dt += timedelta(days=1)
+        deltas.append((start_dt - now).total_seconds())
+    return min(deltas) if deltas else None
+
+
+def _get_config_path() -> str:
+    return os.path.join(os.path.dirname(__file__), "config.toml")
+
+
+def _read_config_file(config_path: str) -> dict:
+    import toml
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        return toml.load(f)
+
+
+def _write_config_file(config_path: str, config: dict):
+    import toml
+
+    with open(config_path, "w", encoding="utf-8") as f:
+        toml.dump(config, f)
+
+
+def _get_cached_config(key: str, default: Any) -> Any:
+    """从配置缓存中读取通过 /dream 命令修改过的值，缓存中没有时返回 default"""
+    if _CONFIG_CACHE is None:
+        return default
+    current: Any = _CONFIG_CACHE
+    for k in key.split("."):
+        if not isinstance(current, dict) or k not in current:
+            return default
+        current = current[k]
+    return current
+
+
+@dataclass(slots=True)
+class DreamConfig:
+    """做梦功能配置快照"""
+
+    enabled: bool
+    groups: List[str]
+    times: List[str]
+    check_interval: int
+    dreams_per_day: int
+    dream_interval_minutes: int
+    personality_traits: str
+    admin_users: List[str]
+    napcat_url: str
+    access_token: str
+
+
+def get_dream_config(component) -> DreamConfig:
+    """获取做梦配置快照，配置未被 /dream 命令修改时直接复用上次的结果"""
+    global _DREAM_CONFIG_SNAPSHOT
+    if _DREAM_CONFIG_SNAPSHOT is not None and _DREAM_CONFIG_SNAPSHOT[0] == _CONFIG_VERSION:
+        return _DREAM_CONFIG_SNAPSHOT[1]
+
+    def read(key: str, default: Any) -> Any:
+        return _get_cached_config(key, component.get_config(key, default))
+
+    cfg = DreamConfig(
+        enabled=read("dream.enabled", False),
+        groups=read("dream.groups", []),
+        times=read("dream.times", ["03:00-04:00"]),
+        check_interval=read("dream.check_interval", 60),
+        dreams_per_day=read("dream.dreams_per_day", 1),
+        dream_interval_minutes=read("dream.dream_interval_minutes", 60),
+        personality_traits=read("dream.personality_traits", "此处填入你的bot人格"),
+        admin_users=read("dream.admin_users", []),
+        napcat_url=read("napcat.http_url", "http://127.0.0.1:3000"),
+        access_token=read("napcat.access_token", ""),
+    )
+    _DREAM_CONFIG_SNAPSHOT = (_CONFIG_VERSION, cfg)
+    return cfg
+
+
+async def _load_config_cache() -> dict:
+    """获取配置文件缓存，首次调用时在线程中读取 config.toml"""
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        _CONFIG_CACHE = await asyncio.to_thread(_read_config_file, _get_config_path())
+    return _CONFIG_CACHE
+
+
+async def _flush_config():
+    """将配置缓存写回 config.toml（在线程中执行，不阻塞事件循环）"""
+    global _CONFIG_FLUSH_TASK
+    try:
+        async with _CONFIG_LOCK:
+            if _CONFIG_CACHE is None:
+                return
+            snapshot = copy.deepcopy(_CONFIG_CACHE)
+            await asyncio.to_thread(_write_config_file, _get_config_path(), snapshot)
+        logger.debug("[梦境] 配置已写入 config.toml")
+    except Exception as e:
+        logger.error(f"[梦境] 写入配置文件失败：{e}")
+    finally:
+        _CONFIG_FLUSH_TASK = None
+
+
+def _start_config_flush():
+    global _CONFIG_FLUSH_HANDLE, _CONFIG_FLUSH_TASK
+    _CONFIG_FLUSH_HANDLE = None
+    _CONFIG_FLUSH_TASK = asyncio.create_task(_flush_config())
+
+
+def _schedule_config_flush():
+    """延迟写回配置，短时间内的多次修改合并为一次写入"""
+    global _CONFIG_FLUSH_HANDLE
+    if _CONFIG_FLUSH_HANDLE is not None:
+        _CONFIG_FLUSH_HANDLE.cancel()
+    loop = asyncio.get_running_loop()
+    _CONFIG_FLUSH_HANDLE = loop.call_later(CONFIG_FLUSH_DELAY, _start_config_flush)
+
+
+async def flush_pending_config():
+    """立即写回尚未落盘的配置修改（插件停止时调用）"""
+    global _CONFIG_FLUSH_HANDLE
+    if _CONFIG_FLUSH_HANDLE is not None:
+        _CONFIG_FLUSH_HANDLE.cancel()
+        _CONFIG_FLUSH_HANDLE = None
+        await _flush_config()
+    elif _CONFIG_FLUSH_TASK is not None:
+        await _CONFIG_FLUSH_TASK
+
+
+_EMPTY_SEG_DATA: Dict[str, Any] = {}  # 共享的空 data，只读不可修改
+
+# NapCat 消息段类型 -> 文本转换函数，未列出的类型统一显示为 [类型]
+_SEG_HANDLERS = {
+    "text": lambda d: d.get("text", ""),
+    "at": lambda d: f"[AT:{d.get('qq', '')}]",
+    "face": lambda d: "[表情]",
+    "image": lambda d: "[图片]",
+    "record": lambda d: "[语音]",
+    "video": lambda d: "[视频]",
+    "reply": lambda d: "[回复]",
+}
+
+
+def _forward_node(user_id: str, nickname: str, content: str) -> dict:
+    """构造一条合并转发消息节点"""
+    return {
+        "type": "node",
+        "data": {"user_id": user_id, "nickname": nickname, "content": content},
+    }
 
 
 class NapCatAPI:
@@ -46,33 +300,26 @@ class NapCatAPI:
     def __init__(self, base_url: str, access_token: str = ""):
         self.base_url = base_url.rstrip("/")
         self.access_token = access_token
-        self.session: Optional[aiohttp.ClientSession] = None
-
-    async def _get_session(self) -> aiohttp.ClientSession:
-        if self.session is None or self.session.closed:
-            self.session = aiohttp.ClientSession()
-        return self.session
-
-    async def close(self):
-        if self.session and not self.session.closed:
-            await self.session.close()
+        self._headers: Dict[str, str] = {"Content-Type": "application/json"}
+        if access_token:
+            self._headers["Authorization"] = f"Bearer {access_token}"
 
     async def call_api(self, action: str, params: dict = None) -> dict:
         """调用 NapCat API"""
-        session = await self._get_session()
+        session = await get_shared_session()
         url = f"{self.base_url}/{action}"
-        headers = {}
-        if self.access_token:
-            headers["Authorization"] = f"Bearer {self.access_token}"
+        headers = self._headers
 
         try:
-            async with session.post(url, json=params or {}, headers=headers, timeout=30) as resp:
-                data = await resp.json()
-                if data.get("status") == "ok":
-                    return data.get("data", {})
-                else:
-                    logger.error(f"API 调用失败: {action} - {data}")
-                    return {}
+            body = _json_dumps(params or {})
+            async with _NAPCAT_SEMAPHORE:
+                async with session.post(url, data=body, headers=headers) as resp:
+                    data = _json_loads(await resp.read())
+            if data.get("status") == "ok":
+                return data.get("data", {})
+            else:
+                logger.error(f"API 调用失败: {action} - {data}")
+                return {}
         except asyncio.TimeoutError:
             logger.error(f"API 调用超时: {action}")
             return {}
@@ -124,6 +371,8 @@ class NapCatAPI:
 class DreamGenerator:
     """梦境生成器 - 根据群聊内容生成荒诞梦境"""
     
+    EMPTY_CONTEXT = "群里很安静，什么都没发生。"
+    
     DREAM_PROMPT = """# 梦境生成器
 
 你是一个梦境生成器，根据群聊内容生成荒诞、有趣的梦境。
@@ -142,24 +391,27 @@ class DreamGenerator:
 ## 生成梦境
 直接输出梦境内容，不要有任何前缀或解释。"""
 
-    def __init__(self):
+    def __init__(self, bot_name: str, personality_traits: str):
         self.dream_llm = LLMRequest(
             model_set=model_config.model_task_config.replyer,
             request_type="dream"
         )
+        self._prompt_prefix = ""
+        self._prompt_suffix = ""
+        self.set_persona(bot_name, personality_traits)
     
-    async def generate_dream(
-        self, 
-        bot_name: str,
-        personality_traits: str,
-        chat_context: str
-    ) -> str:
-        """生成梦境内容"""
-        prompt = self.DREAM_PROMPT.format(
+    def set_persona(self, bot_name: str, personality_traits: str):
+        """预先填入提示词中不变的人格部分，生成时只需拼接聊天背景"""
+        prefix, suffix = self.DREAM_PROMPT.split("{chat_context}")
+        self._prompt_prefix = prefix.format(
             bot_name=bot_name,
             personality_traits=personality_traits,
-            chat_context=chat_context
         )
+        self._prompt_suffix = suffix
+    
+    async def generate_dream(self, chat_context: str) -> str:
+        """生成梦境内容"""
+        prompt = self._prompt_prefix + chat_context + self._prompt_suffix
         
         try:
             result, _ = await self.dream_llm.generate_response_async(prompt=prompt)
@@ -168,37 +420,93 @@ class DreamGenerator:
             logger.error(f"[梦境生成] 生成失败: {e}")
             return "梦见自己在数据海洋里游泳，醒来发现只是内存溢出喵。"
     
-    async def get_recent_chat_context(self, stream_id: str, limit: int = 20) -> str:
-        """获取最近的聊天内容作为梦境素材"""
+    async def get_recent_chat_context(self, stream_id: str, limit: int = 10) -> str:
+        """获取最近的聊天内容作为梦境素材（最多 limit 条有文本的消息）"""
         try:
-            messages = await asyncio.to_thread(
+            rows = await asyncio.to_thread(
                 lambda: list(
                     Messages.select(
                         Messages.user_nickname,
                         Messages.processed_plain_text,
-                        Messages.time
                     )
-                    .where(Messages.chat_id == stream_id)
+                    .where(
+                        (Messages.chat_id == stream_id)
+                        & Messages.processed_plain_text.is_null(False)
+                        & (Messages.processed_plain_text != "")
+                    )
                     .order_by(Messages.time.desc())
                     .limit(limit)
-                    .execute()
+                    .tuples()
+                    .iterator()
                 )
             )
             
-            if not messages:
-                return "群里很安静，什么都没发生。"
-            
-            context_parts = []
-            for msg in reversed(messages):
-                name = msg.user_nickname or "某人"
-                text = msg.processed_plain_text or ""
-                if text:
-                    context_parts.append(f"{name}: {text[:50]}")
-            
-            return "\n".join(context_parts[-10:])
+            return self._format_chat_context(reversed(rows))
         except Exception as e:
             logger.error(f"[梦境生成] 获取聊天上下文失败: {e}")
-            return "群里很安静，什么都没发生。"
+            return self.EMPTY_CONTEXT
+    
+    async def get_recent_chat_context_bulk(
+        self, stream_ids: List[str], limit_per_stream: int = 10
+    ) -> Dict[str, str]:
+        """一次查询获取多个聊天流的最近聊天内容
+        
+        Returns:
+            {stream_id: 聊天背景}，没有消息的聊天流也会返回默认文本
+        """
+        if not stream_ids:
+            return {}
+        
+        try:
+            rows = await asyncio.to_thread(
+                self._query_recent_rows_bulk, list(stream_ids), limit_per_stream
+            )
+        except Exception as e:
+            # 例如 SQLite 版本过旧不支持窗口函数，退回逐个聊天流查询
+            logger.warning(f"[梦境生成] 批量获取聊天上下文失败，改为逐个查询: {e}")
+            contexts = await asyncio.gather(*(
+                self.get_recent_chat_context(stream_id, limit_per_stream)
+                for stream_id in stream_ids
+            ))
+            return dict(zip(stream_ids, contexts))
+        
+        grouped: Dict[str, List[Tuple[str, str]]] = {}
+        for chat_id, name, text in rows:
+            grouped.setdefault(chat_id, []).append((name, text))
+        
+        return {
+            stream_id: self._format_chat_context(grouped.get(stream_id, ()))
+            for stream_id in stream_ids
+        }
+    
+    @staticmethod
+    def _query_recent_rows_bulk(stream_ids: List[str], limit_per_stream: int) -> List[tuple]:
+        """按聊天流分区取最近 N 条有文本的消息，结果按时间正序排列"""
+        database = Messages._meta.database
+        table = Messages._meta.table_name
+        chat_id = Messages.chat_id.column_name
+        nickname = Messages.user_nickname.column_name
+        text = Messages.processed_plain_text.column_name
+        msg_time = Messages.time.column_name
+        placeholders = ", ".join([database.param] * len(stream_ids))
+        
+        sql = (
+            f"SELECT {chat_id}, {nickname}, {text} FROM ("
+            f"SELECT {chat_id}, {nickname}, {text}, {msg_time}, "
+            f"ROW_NUMBER() OVER (PARTITION BY {chat_id} ORDER BY {msg_time} DESC) AS rn "
+            f"FROM {table} "
+            f"WHERE {chat_id} IN ({placeholders}) "
+            f"AND {text} IS NOT NULL AND {text} != ''"
+            f") WHERE rn <= {database.param} "
+            f"ORDER BY {chat_id}, {msg_time} ASC"
+        )
+        cursor = database.execute_sql(sql, [*stream_ids, limit_per_stream])
+        return cursor.fetchall()
+    
+    def _format_chat_context(self, rows) -> str:
+        """将 (昵称, 文本) 行格式化为梦境素材"""
+        context = "\n".join(f"{name or '某人'}: {text[:50]}" for name, text in rows)
+        return context or self.EMPTY_CONTEXT
 
 
 class DreamHandler(BaseEventHandler):
@@ -215,7 +523,12 @@ class DreamHandler(BaseEventHandler):
         self._running = False
         self._dream_generator: Optional[DreamGenerator] = None
         self._api: Optional[NapCatAPI] = None
-        self._dreamed_groups: Dict[str, List[float]] = {}
+        self._dreamed_groups: Dict[date, Dict[str, List[float]]] = {}
+        self._parsed_times: Optional[List[Tuple[dt_time, dt_time]]] = None
+        self._parsed_times_src: Optional[Tuple[str, ...]] = None
+        self._wakeup = asyncio.Event()
+        self._last_logged_err_at = 0.0
+        self._consecutive_errors = 0
         DreamHandler._instance = self
     
     @classmethod
@@ -223,6 +536,10 @@ class DreamHandler(BaseEventHandler):
         """获取 DreamHandler 实例"""
         return cls._instance
     
+    def wake_up(self):
+        """唤醒梦境循环，立即重新检查（配置变更或重置计数后调用）"""
+        self._wakeup.set()
+    
     def reset_dream_count(self, group_id: Optional[str] = None):
         """重置做梦计数
         
@@ -230,14 +547,13 @@ class DreamHandler(BaseEventHandler):
             group_id: 指定群号则只重置该群，None 则重置所有群
         """
         if group_id:
-            today = datetime.now().date()
-            today_key = f"{today}_{group_id}"
-            if today_key in self._dreamed_groups:
-                del self._dreamed_groups[today_key]
+            today_map = self._dreamed_groups.get(datetime.now().date(), {})
+            if today_map.pop(str(group_id), None) is not None:
                 logger.info(f"[梦境] 已重置群 {group_id} 的做梦计数")
         else:
             self._dreamed_groups.clear()
             logger.info("[梦境] 已重置所有群的做梦计数")
+        self.wake_up()
     
     async def execute(
         self, message=None
@@ -245,92 +561,100 @@ class DreamHandler(BaseEventHandler):
         if self._running:
             return True, True, "梦境循环已在运行", None, None
         
-        dream_enabled = self.get_config("dream.enabled", False)
-        if not dream_enabled:
+        cfg = get_dream_config(self)
+        if not cfg.enabled:
             logger.info("[梦境] 做梦功能未启用")
             return True, True, "做梦功能未启用", None, None
         
         self._running = True
-        self._dream_generator = DreamGenerator()
-        
-        napcat_url = self.get_config("napcat.http_url", "http://127.0.0.1:3000")
-        access_token = self.get_config("napcat.access_token", "")
-        self._api = NapCatAPI(napcat_url, access_token)
         
-        dream_groups = self.get_config("dream.groups", [])
-        dream_times = self.get_config("dream.times", ["03:00-04:00"])
-        check_interval = self.get_config("dream.check_interval", 60)
-        personality_traits = self.get_config("dream.personality_traits", "此处填入你的bot人格")
+        self._api = NapCatAPI(cfg.napcat_url, cfg.access_token)
+        self._dream_generator = DreamGenerator(global_config.bot.nickname, cfg.personality_traits)
         
-        if not dream_groups:
+        if not cfg.groups:
             logger.info("[梦境] 未配置做梦的群，跳过")
             return True, True, "未配置做梦群", None, None
         
-        logger.info(f"[梦境] 启动梦境循环，监控群: {dream_groups}，时间段: {dream_times}")
+        logger.info(f"[梦境] 启动梦境循环，监控群: {cfg.groups}，时间段: {cfg.times}")
         
-        asyncio.create_task(self._dream_loop(
-            dream_groups=dream_groups,
-            dream_times=dream_times,
-            check_interval=check_interval,
-            personality_traits=personality_traits,
-        ))
+        asyncio.create_task(self._dream_loop(cfg))
         
         return True, True, "梦境循环已启动", None, None
     
-    def _is_in_dream_time(self, dream_times: List[str]) -> bool:
-        """检查当前时间是否在梦境时间段内"""
-        now = datetime.now().time()
-        
-        for time_range in dream_times:
+    def _get_parsed_times(self, dream_times: List[str]) -> List[Tuple[dt_time, dt_time]]:
+        """解析梦境时间段，配置未变化时直接复用上次的解析结果"""
+        src = tuple(dream_times)
+        if self._parsed_times is not None and src == self._parsed_times_src:
+            return self._parsed_times
+        
+        parsed: List[Tuple[dt_time, dt_time]] = []
+        for time_range in src:
             try:
                 start_str, end_str = time_range.split("-")
                 start_hour, start_min = map(int, start_str.split(":"))
                 end_hour, end_min = map(int, end_str.split(":"))
-                
-                start_time = dt_time(start_hour, start_min)
-                end_time = dt_time(end_hour, end_min)
-                
-                if start_time <= end_time:
-                    if start_time <= now <= end_time:
-                        return True
-                else:
-                    if now >= start_time or now <= end_time:
-                        return True
+                parsed.append((dt_time(start_hour, start_min), dt_time(end_hour, end_min)))
             except Exception as e:
                 logger.warning(f"[梦境] 解析时间段失败: {time_range} - {e}")
         
+        self._parsed_times = parsed
+        self._parsed_times_src = src
+        return parsed
+    
+    def _is_in_dream_time(self, dream_times: List[str]) -> bool:
+        """检查当前时间是否在梦境时间段内"""
+        now = datetime.now().time()
+        
+        for start_time, end_time in self._get_parsed_times(dream_times):
+            if start_time <= end_time:
+                if start_time <= now <= end_time:
+                    return True
+            else:
+                if now >= start_time or now <= end_time:
+                    return True
+        
         return False
     
-    async def _dream_loop(
-        self,
-        dream_groups: List[str],
-        dream_times: List[str],
-        check_interval: int,
-        personality_traits: str,
-    ):
+    async def _dream_loop(self, cfg: DreamConfig):
         """梦境生成循环"""
         bot_name = global_config.bot.nickname
-        dreams_per_day = self.get_config("dream.dreams_per_day", 1)
-        dream_interval_seconds = self.get_config("dream.dream_interval_minutes", 60) * 60
+        config_version = _CONFIG_VERSION
+        
+        is_in_dream_time = self._is_in_dream_time
+        now_fn = datetime.now
+        time_fn = time.time
+        state = DREAM_STATE
         
         while self._running:
             try:
-                now = datetime.now()
+                if config_version != _CONFIG_VERSION:
+                    config_version = _CONFIG_VERSION
+                    cfg = get_dream_config(self)
+                    self._dream_generator.set_persona(bot_name, cfg.personality_traits)
+                    logger.debug("[梦境] 检测到配置变更，已重新读取梦境配置")
+                
+                if not cfg.enabled:
+                    # 已通过 /dream disable 关闭，等待配置变更唤醒后再检查
+                    await self._wait_next_tick(DREAM_IDLE_MAX_SLEEP)
+                    continue
+                
+                dream_times = cfg.times
+                check_interval = cfg.check_interval
+                dream_interval_seconds = cfg.dream_interval_minutes * 60
+                
+                now = now_fn()
                 today = now.date()
-                current_timestamp = time.time()
+                current_timestamp = time_fn()
                 
-                in_dream_time = self._is_in_dream_time(dream_times)
+                in_dream_time = is_in_dream_time(dream_times)
                 
                 if in_dream_time:
-                    for group_id in dream_groups:
-                        today_key = f"{today}_{group_id}"
-                        
-                        if today_key not in self._dreamed_groups:
-                            self._dreamed_groups[today_key] = []
+                    today_map = self._dreamed_groups.setdefault(today, {})
+                    eligible_groups: List[Tuple[str, List[float]]] = []
+                    for group_id in cfg.groups:
+                        dream_times_today = today_map.setdefault(str(group_id), [])
                         
-                        dream_times_today = self._dreamed_groups[today_key]
-                        
-                        if len(dream_times_today) >= dreams_per_day:
+                        if len(dream_times_today) >= cfg.dreams_per_day:
                             continue
                         
                         if dream_times_today:
@@ -339,52 +663,97 @@ class DreamHandler(BaseEventHandler):
                                 logger.debug(f"[梦境] 群 {group_id} 距离上次做梦时间过短，跳过")
                                 continue
                         
-                        if DREAM_STATE["is_dreaming"]:
+                        if state["is_dreaming"]:
                             logger.debug(f"[梦境] 正在做梦中，跳过群 {group_id}")
                             continue
                         
-                        logger.info(f"[梦境] 开始为群 {group_id} 生成梦境（今日第 {len(dream_times_today) + 1} 次）...")
-                        
-                        DREAM_STATE["is_dreaming"] = True
-                        DREAM_STATE["dream_groups"].add(group_id)
-                        
+                        eligible_groups.append((group_id, dream_times_today))
+
+                    if eligible_groups:
+                        state["is_dreaming"] = True
+                        _add_dream_groups(group_id for group_id, _ in eligible_groups)
+
                         try:
-                            stream_id = self._generate_stream_id("qq", str(group_id))
-                            chat_context = await self._dream_generator.get_recent_chat_context(stream_id)
-                            
-                            dream_content = await self._dream_generator.generate_dream(
-                                bot_name=bot_name,
-                                personality_traits=personality_traits,
-                                chat_context=chat_context
+                            stream_ids = {
+                                group_id: self._generate_stream_id("qq", str(group_id))
+                                for group_id, _ in eligible_groups
+                            }
+                            contexts = await self._dream_generator.get_recent_chat_context_bulk(
+                                list(stream_ids.values())
+                            )
+                            await asyncio.gather(
+                                *[
+                                    self._process_group_dream(
+                                        group_id=group_id,
+                                        dream_times_today=dream_times_today,
+                                        bot_name=bot_name,
+                                        dream_timestamp=current_timestamp,
+                                        chat_context=contexts[stream_ids[group_id]],
+                                    )
+                                    for group_id, dream_times_today in eligible_groups
+                                ],
+                                return_exceptions=True,
                             )
-                            
-                            await self._send_dream_forward(group_id, bot_name, dream_content)
-                            
-                            self._dreamed_groups[today_key].append(current_timestamp)
-                            logger.info(f"[梦境] 群 {group_id} 梦境发送完成（今日第 {len(self._dreamed_groups[today_key])} 次）")
-                            
-                            await asyncio.sleep(5)
-                            
                         finally:
-                            DREAM_STATE["is_dreaming"] = False
-                            DREAM_STATE["dream_groups"].discard(group_id)
+                            state["is_dreaming"] = False
+                            _remove_dream_groups(group_id for group_id, _ in eligible_groups)
                 else:
-                    if self._dreamed_groups:
-                        today_str = now.strftime("%Y-%m-%d")
-                        new_dreamed = {}
-                        for key, times_list in self._dreamed_groups.items():
-                            if key.startswith(today_str):
-                                new_dreamed[key] = times_list
-                        if len(new_dreamed) < len(self._dreamed_groups):
-                            logger.info("[梦境] 新的一天开始，重置做梦记录")
-                        self._dreamed_groups = new_dreamed
+                    if any(day != today for day in self._dreamed_groups):
+                        logger.info("[梦境] 新的一天开始，重置做梦记录")
+                        self._dreamed_groups = {today: self._dreamed_groups.get(today, {})}
+                
+                sleep_for = check_interval
+                if not in_dream_time:
+                    until_next = _seconds_until_next_window(self._get_parsed_times(dream_times), now)
+                    if until_next is not None:
+                        sleep_for = min(max(until_next, 1), DREAM_IDLE_MAX_SLEEP)
                 
-                await asyncio.sleep(check_interval)
+                self._consecutive_errors = 0
+                await self._wait_next_tick(sleep_for)
                 
             except Exception as e:
-                logger.error(f"[梦境] 循环出错: {e}", exc_info=True)
-                await asyncio.sleep(check_interval)
+                error_time = time.time()
+                if error_time - self._last_logged_err_at > DREAM_ERROR_TRACEBACK_INTERVAL:
+                    self._last_logged_err_at = error_time
+                    logger.error(f"[梦境] 循环出错: {e}", exc_info=True)
+                else:
+                    logger.error(f"[梦境] 循环出错: {e!r}")
+                backoff = min(cfg.check_interval * 2 ** self._consecutive_errors, DREAM_ERROR_MAX_BACKOFF)
+                self._consecutive_errors += 1
+                await asyncio.sleep(backoff)
     
+    async def _wait_next_tick(self, timeout: float):
+        """等待下一次检查，期间被 wake_up() 唤醒则提前返回"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+    
+    async def _process_group_dream(
+        self,
+        group_id: str,
+        dream_times_today: List[float],
+        bot_name: str,
+        dream_timestamp: float,
+        chat_context: str,
+    ):
+        """为单个群生成并发送梦境"""
+        logger.info(f"[梦境] 开始为群 {group_id} 生成梦境（今日第 {len(dream_times_today) + 1} 次）...")
+
+        try:
+            dream_content = await self._dream_generator.generate_dream(chat_context)
+
+            await self._send_dream_forward(group_id, bot_name, dream_content)
+
+            dream_times_today.append(dream_timestamp)
+            logger.info(f"[梦境] 群 {group_id} 梦境发送完成（今日第 {len(dream_times_today)} 次）")
+
+        except Exception as e:
+            logger.error(f"[梦境] 群 {group_id} 做梦失败: {e}", exc_info=True)
+        finally:
+            _remove_dream_groups((group_id,))
+
     async def _send_dream_forward(self, group_id: str, bot_name: str, dream_content: str):
         """以转发消息形式发送梦境"""
         try:
@@ -393,22 +762,8 @@ class DreamHandler(BaseEventHandler):
             dream_title = f"💤 {bot_name}的梦境记录"
             
             messages = [
-                {
-                    "type": "node",
-                    "data": {
-                        "user_id": bot_qq,
-                        "nickname": bot_name,
-                        "content": dream_title
-                    }
-                },
-                {
-                    "type": "node",
-                    "data": {
-                        "user_id": bot_qq,
-                        "nickname": bot_name,
-                        "content": dream_content
-                    }
-                }
+                _forward_node(bot_qq, bot_name, dream_title),
+                _forward_node(bot_qq, bot_name, dream_content),
             ]
             
             result = await self._api.send_group_forward_msg(group_id, messages)
@@ -423,9 +778,7 @@ class DreamHandler(BaseEventHandler):
     
     def _generate_stream_id(self, platform: str, group_id: str) -> str:
         """生成聊天流ID"""
-        components = [platform, str(group_id)]
-        key = "_".join(components)
-        return hashlib.md5(key.encode()).hexdigest()
+        return _stream_id(platform, str(group_id))
 
 
 def is_dreaming() -> bool:
@@ -433,9 +786,19 @@ def is_dreaming() -> bool:
     return DREAM_STATE["is_dreaming"]
 
 
-def get_dream_groups() -> Set[str]:
-    """获取正在做梦的群（供外部调用）"""
-    return DREAM_STATE["dream_groups"].copy()
+def get_dream_groups() -> FrozenSet[str]:
+    """获取正在做梦的群（供外部调用，返回只读快照）"""
+    return DREAM_STATE["dream_groups_frozen"]
+
+
+def _add_dream_groups(group_ids):
+    DREAM_STATE["dream_groups"].update(group_ids)
+    DREAM_STATE["dream_groups_frozen"] = frozenset(DREAM_STATE["dream_groups"])
+
+
+def _remove_dream_groups(group_ids):
+    DREAM_STATE["dream_groups"].difference_update(group_ids)
+    DREAM_STATE["dream_groups_frozen"] = frozenset(DREAM_STATE["dream_groups"])
 
 
 class DreamCommand(BaseCommand):
@@ -443,7 +806,7 @@ class DreamCommand(BaseCommand):
     
     command_name: str = "dream"
     command_description: str = "梦境管理命令"
-    command_pattern: str = r"^/dream\s+(?P<action>help|reset|status|config|enable|disable|set|test)\s*(?P<params>.*)$"
+    command_pattern: str = DREAM_COMMAND_PATTERN
     
     async def execute(self) -> Tuple[bool, Optional[str], bool]:
         action = self.matched_groups.get("action", "").strip()
@@ -513,13 +876,15 @@ class DreamCommand(BaseCommand):
             await self.send_text("正在做梦，请稍后再试")
             return False, "正在做梦", True
         
+        cfg = get_dream_config(self)
+        bot_name = global_config.bot.nickname
         if not handler._dream_generator:
-            handler._dream_generator = DreamGenerator()
+            handler._dream_generator = DreamGenerator(bot_name, cfg.personality_traits)
+        else:
+            handler._dream_generator.set_persona(bot_name, cfg.personality_traits)
         
         if not handler._api:
-            napcat_url = self.get_config("napcat.http_url", "http://127.0.0.1:3000")
-            access_token = self.get_config("napcat.access_token", "")
-            handler._api = NapCatAPI(napcat_url, access_token)
+            handler._api = NapCatAPI(cfg.napcat_url, cfg.access_token)
         
         group_id = params.strip() if params else None
         
@@ -532,20 +897,13 @@ class DreamCommand(BaseCommand):
         await self.send_text(f"开始为群 {group_id} 生成测试梦境...")
         
         DREAM_STATE["is_dreaming"] = True
-        DREAM_STATE["dream_groups"].add(group_id)
+        _add_dream_groups((group_id,))
         
         try:
-            bot_name = global_config.bot.nickname
-            personality_traits = self.get_config("dream.personality_traits", "此处填入你的bot人格")
-            
             stream_id = handler._generate_stream_id("qq", str(group_id))
             chat_context = await handler._dream_generator.get_recent_chat_context(stream_id)
             
-            dream_content = await handler._dream_generator.generate_dream(
-                bot_name=bot_name,
-                personality_traits=personality_traits,
-                chat_context=chat_context
-            )
+            dream_content = await handler._dream_generator.generate_dream(chat_context)
             
             await handler._send_dream_forward(group_id, bot_name, dream_content)
             
@@ -558,14 +916,14 @@ class DreamCommand(BaseCommand):
             return False, f"测试失败: {e}", True
         finally:
             DREAM_STATE["is_dreaming"] = False
-            DREAM_STATE["dream_groups"].discard(group_id)
+            _remove_dream_groups((group_id,))
     
     def _check_permission(self) -> bool:
         """检查权限"""
         if not self.message or not self.message.message_info:
             return False
         user_id = str(self.message.message_info.user_info.user_id)
-        admin_users = self.get_config("dream.admin_users", [])
+        admin_users = get_dream_config(self).admin_users
         if not admin_users:
             return False
         return user_id in [str(uid) for uid in admin_users]
@@ -593,25 +951,21 @@ class DreamCommand(BaseCommand):
             await self.send_text("梦境处理器未初始化")
             return False, "处理器未初始化", True
         
-        enabled = self.get_config("dream.enabled", False)
-        groups = self.get_config("dream.groups", [])
-        times = self.get_config("dream.times", [])
-        dreams_per_day = self.get_config("dream.dreams_per_day", 1)
+        cfg = get_dream_config(self)
         is_dreaming_now = is_dreaming()
         
         status_lines = [
-            f"梦境功能状态：{'已启用' if enabled else '已禁用'}",
-            f"做梦群组：{', '.join(groups) if groups else '未配置'}",
-            f"做梦时间：{', '.join(times)}",
-            f"每日次数：{dreams_per_day} 次",
+            f"梦境功能状态：{'已启用' if cfg.enabled else '已禁用'}",
+            f"做梦群组：{', '.join(cfg.groups) if cfg.groups else '未配置'}",
+            f"做梦时间：{', '.join(cfg.times)}",
+            f"每日次数：{cfg.dreams_per_day} 次",
             f"当前状态：{'正在做梦' if is_dreaming_now else '空闲'}",
         ]
         
-        if handler._dreamed_groups:
+        today_map = handler._dreamed_groups.get(datetime.now().date())
+        if today_map:
             status_lines.append("\n今日做梦记录：")
-            for key, times_list in handler._dreamed_groups.items():
-                parts = key.split("_", 1)
-                group_id = parts[1] if len(parts) > 1 else key
+            for group_id, times_list in today_map.items():
                 status_lines.append(f"  群 {group_id}：{len(times_list)} 次")
         
         await self.send_text("\n".join(status_lines))
@@ -620,17 +974,19 @@ class DreamCommand(BaseCommand):
     async def _handle_config(self, params: str) -> Tuple[bool, Optional[str], bool]:
         """处理配置查询命令"""
         if params:
-            value = self.get_config(f"dream.{params}", "未找到配置项")
+            key = f"dream.{params}"
+            value = _get_cached_config(key, self.get_config(key, "未找到配置项"))
             await self.send_text(f"{params} = {value}")
         else:
+            cfg = get_dream_config(self)
             config_items = [
-                "enabled = " + str(self.get_config("dream.enabled", False)),
-                "groups = " + str(self.get_config("dream.groups", [])),
-                "times = " + str(self.get_config("dream.times", [])),
-                "dreams_per_day = " + str(self.get_config("dream.dreams_per_day", 1)),
-                "dream_interval_minutes = " + str(self.get_config("dream.dream_interval_minutes", 60)),
-                "check_interval = " + str(self.get_config("dream.check_interval", 60)),
-                "personality_traits = " + str(self.get_config("dream.personality_traits", "")),
+                f"enabled = {cfg.enabled}",
+                f"groups = {cfg.groups}",
+                f"times = {cfg.times}",
+                f"dreams_per_day = {cfg.dreams_per_day}",
+                f"dream_interval_minutes = {cfg.dream_interval_minutes}",
+                f"check_interval = {cfg.check_interval}",
+                f"personality_traits = {cfg.personality_traits}",
             ]
             await self.send_text("梦境配置：\n" + "\n".join(config_items))
         
@@ -638,13 +994,13 @@ class DreamCommand(BaseCommand):
     
     async def _handle_enable(self) -> Tuple[bool, Optional[str], bool]:
         """处理启用命令"""
-        self._update_config("dream.enabled", True)
+        await self._update_config("dream.enabled", True)
         await self.send_text("梦境功能已启用")
         return True, "已启用", True
     
     async def _handle_disable(self) -> Tuple[bool, Optional[str], bool]:
         """处理禁用命令"""
-        self._update_config("dream.enabled", False)
+        await self._update_config("dream.enabled", False)
         await self.send_text("梦境功能已禁用")
         return True, "已禁用", True
     
@@ -676,12 +1032,11 @@ class DreamCommand(BaseCommand):
             elif key in ["dreams_per_day", "dream_interval_minutes", "check_interval"]:
                 value = int(value_str)
             elif key in ["groups", "times"]:
-                import json
-                value = json.loads(value_str)
+                value = _json_loads(value_str)
             else:
                 value = value_str
             
-            self._update_config(f"dream.{key}", value)
+            await self._update_config(f"dream.{key}", value)
             await self.send_text(f"已设置 {key} = {value}")
             return True, "设置成功", True
             
@@ -689,28 +1044,26 @@ class DreamCommand(BaseCommand):
             await self.send_text(f"设置失败：{e}")
             return False, f"设置失败: {e}", True
     
-    def _update_config(self, key: str, value: Any):
-        """更新配置（内存中）"""
-        import toml
-        import os
-        
-        config_path = os.path.join(os.path.dirname(__file__), "config.toml")
-        
+    async def _update_config(self, key: str, value: Any):
+        """更新配置（先改缓存，稍后合并写回 config.toml）"""
+        global _CONFIG_VERSION
         try:
-            with open(config_path, "r", encoding="utf-8") as f:
-                config = toml.load(f)
-            
-            keys = key.split(".")
-            current = config
-            for k in keys[:-1]:
-                if k not in current:
-                    current[k] = {}
-                current = current[k]
-            current[keys[-1]] = value
-            
-            with open(config_path, "w", encoding="utf-8") as f:
-                toml.dump(config, f)
+            async with _CONFIG_LOCK:
+                config = await _load_config_cache()
+                
+                keys = key.split(".")
+                current = config
+                for k in keys[:-1]:
+                    if k not in current:
+                        current[k] = {}
+                    current = current[k]
+                current[keys[-1]] = value
+                _CONFIG_VERSION += 1
             
+            _schedule_config_flush()
+            handler = DreamHandler.get_instance()
+            if handler:
+                handler.wake_up()
             logger.info(f"[梦境] 配置已更新：{key} = {value}")
         except Exception as e:
             logger.error(f"[梦境] 更新配置失败：{e}")
@@ -728,22 +1081,57 @@ class DreamMessageInterceptor(BaseEventHandler):
     async def execute(
         self, message
     ) -> Tuple[bool, bool, Optional[str], None, None]:
-        if not is_dreaming():
+        if not DREAM_STATE["is_dreaming"]:
             return True, True, "不在做梦，放行", None, None
         
         if not message or not message.message_info:
             return True, True, "无消息信息，放行", None, None
         
         group_id = message.chat_stream.stream_id
-        dream_groups = get_dream_groups()
         
-        if group_id in dream_groups:
+        if group_id in DREAM_STATE["dream_groups_frozen"]:
             logger.info(f"[梦境拦截] 群 {group_id} 正在做梦，拦截消息")
             return True, False, "做梦中，消息已拦截", None, None
         
         return True, True, "非做梦群，放行", None, None
 
 
+# 同步写入的消息行中对所有消息都相同的字段
+_BASE_MSG_DEFAULTS: Dict[str, Any] = {
+    "reply_to": "",
+    "interest_value": 0,
+    "key_words": "",
+    "key_words_lite": "",
+    "is_mentioned": False,
+    "is_at": False,
+    "reply_probability_boost": 0.0,
+    "chat_info_platform": "qq",
+    "chat_info_user_platform": "qq",
+    "chat_info_group_platform": "qq",
+    "chat_info_group_name": "",
+    "user_platform": "qq",
+    "priority_mode": "",
+    "priority_info": "",
+    "is_emoji": False,
+    "is_picid": False,
+    "is_command": False,
+    "intercept_message_level": 0,
+    "is_notify": False,
+    "selected_expressions": "",
+}
+
+
+class SyncedMessage(NamedTuple):
+    """从 NapCat 拉取并解析后的一条待同步消息"""
+
+    msg_id: str
+    msg_time: float
+    sender_id: str
+    sender_name: str
+    sender_card: str
+    content: str
+
+
 class MaiShangHaoHandler(BaseEventHandler):
     """麦上号事件处理器 - 启动时同步离线消息"""
 
@@ -751,6 +1139,9 @@ class MaiShangHaoHandler(BaseEventHandler):
     handler_name = "mai_shang_hao_handler"
     handler_description = "启动时同步离线消息并触发 planner"
 
+    _sqlite_wal_enabled = False
+    _sync_indexes_ready = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._synced = False
@@ -771,6 +1162,7 @@ class MaiShangHaoHandler(BaseEventHandler):
         trigger_planner = self.get_config("sync.trigger_planner", True)
         planner_delay = self.get_config("sync.planner_delay", 3)
         add_markers = self.get_config("sync.add_markers", True)
+        concurrency = max(1, int(self.get_config("sync.concurrency", 4)))
 
         if not sync_groups:
             logger.info("[麦上号] 未配置需要同步的群，跳过同步")
@@ -791,28 +1183,40 @@ class MaiShangHaoHandler(BaseEventHandler):
         await asyncio.sleep(sync_delay)
 
         api = NapCatAPI(napcat_url, access_token)
+        await asyncio.to_thread(self._ensure_sync_indexes, Messages._meta.database)
 
         try:
             total_synced = 0
             total_skipped = 0
             synced_groups_info: List[Dict[str, Any]] = []
+            group_semaphore = asyncio.Semaphore(concurrency)
 
-            for group_id in valid_groups:
+            async def _sync_one(group_id) -> Tuple[int, int, Optional[Dict]]:
                 group_id_str = str(group_id).strip()
-                logger.info(f"[麦上号] 正在同步群 {group_id_str} 的消息...")
-                
-                synced, skipped, latest_msg = await self._sync_group_messages(
-                    api=api,
-                    group_id=group_id_str,
-                    message_count=message_count,
-                    bot_qq=bot_qq,
-                    dedupe_mode=dedupe_mode,
-                    add_markers=add_markers,
-                )
-                
+                async with group_semaphore:
+                    logger.info(f"[麦上号] 正在同步群 {group_id_str} 的消息...")
+                    return await self._sync_group_messages(
+                        api=api,
+                        group_id=group_id_str,
+                        message_count=message_count,
+                        bot_qq=bot_qq,
+                        dedupe_mode=dedupe_mode,
+                        add_markers=add_markers,
+                    )
+
+            results = await asyncio.gather(
+                *[_sync_one(g) for g in valid_groups], return_exceptions=True
+            )
+
+            for group_id, result in zip(valid_groups, results):
+                if isinstance(result, BaseException):
+                    logger.error(f"[麦上号] 同步群 {group_id} 失败: {result}")
+                    continue
+
+                synced, skipped, latest_msg = result
                 total_synced += synced
                 total_skipped += skipped
-                
+
                 if latest_msg:
                     synced_groups_info.append({
                         "group_id": group_id,
@@ -820,8 +1224,6 @@ class MaiShangHaoHandler(BaseEventHandler):
                         "latest_message": latest_msg,
                     })
 
-                await asyncio.sleep(0.5)
-
             self._synced = True
             logger.info(
                 f"[麦上号] 同步完成，新增 {total_synced} 条，跳过 {total_skipped} 条重复消息"
@@ -844,8 +1246,6 @@ class MaiShangHaoHandler(BaseEventHandler):
         except Exception as e:
             logger.error(f"[麦上号] 同步失败: {e}", exc_info=True)
             return True, True, f"同步失败: {e}", None, None
-        finally:
-            await api.close()
 
     async def _sync_group_messages(
         self,
@@ -870,84 +1270,122 @@ class MaiShangHaoHandler(BaseEventHandler):
         logger.info(f"[麦上号] 群 {group_id} 获取到 {len(messages)} 条消息")
 
         stream_id = self._generate_stream_id("qq", group_id)
-        
-        existing_message_ids = await self._get_existing_message_ids(stream_id)
-        existing_message_hashes = await self._get_existing_message_hashes(stream_id)
-        existing_message_times = await self._get_existing_message_times(stream_id)
 
-        synced = 0
         skipped = 0
-        latest_msg_info: Optional[Dict] = None
-        
-        processed_messages: List[Dict] = []
+        processed_messages: List[SyncedMessage] = []
+        # NapCat 返回的 user_id 通常是整数，同时放入字符串形式以兼容不同版本
+        bot_qq = str(bot_qq)
+        bot_ids: Set[Any] = {bot_qq}
+        if bot_qq.isdigit():
+            bot_ids.add(int(bot_qq))
         
         for msg in messages:
+            if not isinstance(msg, dict):
+                logger.error(f"[麦上号] 处理消息失败: 消息不是字典 {type(msg).__name__}")
+                skipped += 1
+                continue
+            
+            sender = msg.get("sender") or {}
+            if not isinstance(sender, dict):
+                logger.error(f"[麦上号] 处理消息失败: sender 不是字典 {type(sender).__name__}")
+                skipped += 1
+                continue
+            
+            raw_sender_id = sender.get("user_id", "")
             try:
-                msg_id = str(msg.get("message_id", ""))
-                sender = msg.get("sender", {})
-                sender_id = str(sender.get("user_id", ""))
+                if raw_sender_id in bot_ids:
+                    continue
+                
+                sender_id = str(raw_sender_id)
                 sender_name = sender.get("nickname", "未知")
                 sender_card = sender.get("card", "") or sender_name
-                msg_time = msg.get("time", 0)
-                
-                if str(sender_id) == str(bot_qq):
-                    continue
-
+                msg_time = float(msg.get("time") or 0)
                 content = self._extract_text(msg)
-                if not content or not content.strip():
-                    continue
-
-                is_duplicate = False
-                if dedupe_mode == "message_id" and msg_id and msg_id in existing_message_ids:
-                    is_duplicate = True
-                elif dedupe_mode == "content_hash":
-                    content_hash = self._generate_content_hash(sender_id, msg_time, content)
-                    if content_hash in existing_message_hashes:
-                        is_duplicate = True
-
-                processed_messages.append({
-                    "msg_id": msg_id,
-                    "msg_time": msg_time,
-                    "sender_id": sender_id,
-                    "sender_name": sender_name,
-                    "sender_card": sender_card,
-                    "content": content,
-                    "is_duplicate": is_duplicate,
-                })
-                
-                if is_duplicate:
-                    skipped += 1
-                else:
-                    latest_msg_info = {
-                        "message_id": msg_id,
-                        "time": msg_time,
-                        "sender_id": sender_id,
-                        "sender_name": sender_name,
-                        "content": content,
-                    }
-
-            except Exception as e:
+                # 没有 message_id 时用时间戳、发送者和内容摘要生成稳定的ID，
+                # 同一毫秒内同一人发的不同消息不会被当作重复
+                msg_id = (
+                    str(msg.get("message_id", ""))
+                    or f"sync_{int(msg_time * 1000)}_{sender_id}_{_content_digest(content):016x}"
+                )
+            except (TypeError, ValueError, AttributeError) as e:
                 logger.error(f"[麦上号] 处理消息失败: {e}")
                 skipped += 1
+                continue
+            
+            if not content or not content.strip():
+                continue
+
+            processed_messages.append(SyncedMessage(
+                msg_id, msg_time, sender_id, sender_name, sender_card, content
+            ))
 
         if not processed_messages:
             logger.info(f"[麦上号] 群 {group_id} 没有需要处理的消息")
             return 0, 0, None
 
-        offline_segments = self._identify_offline_segments(
-            processed_messages, existing_message_times
+        # 只查询本批次涉及的消息，而不是整个聊天流的全部历史
+        candidate_ids = [m.msg_id for m in processed_messages]
+        batch_times = [m.msg_time for m in processed_messages]
+        if add_markers:
+            # 段落边界要等去重后才知道，这里把每条消息可能对应的标记ID都带上，
+            # 重复同步时已写入过的标记会被跳过
+            for msg_time in batch_times:
+                candidate_ids.append(self._marker_message_id("start", msg_time - 0.1))
+                candidate_ids.append(self._marker_message_id("end", msg_time + 0.1))
+        
+        existing_message_ids, existing_message_hashes = (
+            await self._get_existing_dedupe_state(
+                stream_id,
+                candidate_ids,
+                min(batch_times),
+                max(batch_times),
+                dedupe_mode,
+            )
         )
+
+        synced = 0
+        latest_msg_info: Optional[Dict] = None
+        duplicates: List[bool] = []
+        
+        for msg_data in processed_messages:
+            msg_id = msg_data.msg_id
+            is_duplicate = False
+            if dedupe_mode == "message_id" and msg_id in existing_message_ids:
+                is_duplicate = True
+            elif dedupe_mode == "content_hash":
+                content_hash = self._generate_content_hash(
+                    msg_data.sender_id, msg_data.msg_time, msg_data.content
+                )
+                if content_hash in existing_message_hashes:
+                    is_duplicate = True
+            
+            duplicates.append(is_duplicate)
+            if is_duplicate:
+                skipped += 1
+            else:
+                latest_msg_info = {
+                    "message_id": msg_id,
+                    "time": msg_data.msg_time,
+                    "sender_id": msg_data.sender_id,
+                    "sender_name": msg_data.sender_name,
+                    "content": msg_data.content,
+                }
+
+        offline_segments = self._identify_offline_segments(batch_times, duplicates)
         
         logger.info(f"[麦上号] 群 {group_id} 识别到 {len(offline_segments)} 个离线消息段落")
 
-        for segment in offline_segments:
-            segment_synced = await self._store_offline_segment(
+        if offline_segments:
+            synced = await self._store_offline_segments(
                 stream_id=stream_id,
                 group_id=group_id,
-                segment_messages=segment,
+                segments=[
+                    [processed_messages[i] for i in segment]
+                    for segment in offline_segments
+                ],
                 add_markers=add_markers,
+                existing_message_ids=existing_message_ids,
             )
-            synced += segment_synced
 
         logger.info(
             f"[麦上号] 群 {group_id} 同步完成：新增 {synced} 条，跳过 {skipped} 条"
@@ -955,189 +1393,364 @@ class MaiShangHaoHandler(BaseEventHandler):
         return synced, skipped, latest_msg_info
 
     def _identify_offline_segments(
-        self, 
-        processed_messages: List[Dict], 
-        existing_times: Set[float]
-    ) -> List[List[Dict]]:
+        self, times: List[float], duplicates: List[bool]
+    ) -> List[List[int]]:
         """识别离线消息段落
         
         离线消息段落是指：
         1. 连续的新消息（非重复）
         2. 被已知消息"夹在中间"或"在最前面"或"在最后面"
         
+        Args:
+            times: 每条消息的时间戳
+            duplicates: 每条消息是否重复，与 times 一一对应
+        
         Returns:
-            离线消息段落列表，每个段落是一个消息列表
+            离线消息段落列表，每个段落是按时间排序的消息下标列表
         """
-        segments: List[List[Dict]] = []
-        current_segment: List[Dict] = []
-        
-        sorted_messages = sorted(processed_messages, key=lambda x: x["msg_time"])
+        segments: List[List[int]] = []
+        current_segment: List[int] = []
         
-        for msg in sorted_messages:
-            if msg["is_duplicate"]:
+        for i in sorted(range(len(times)), key=times.__getitem__):
+            if duplicates[i]:
                 if current_segment:
                     segments.append(current_segment)
                     current_segment = []
             else:
-                current_segment.append(msg)
+                current_segment.append(i)
         
         if current_segment:
             segments.append(current_segment)
         
         return segments
 
-    async def _store_offline_segment(
+    async def _store_offline_segments(
         self,
         stream_id: str,
         group_id: str,
-        segment_messages: List[Dict],
-        add_markers: bool = True,
+        segments: List[List[SyncedMessage]],
+        add_markers: bool,
+        existing_message_ids: Set[str],
     ) -> int:
-        """存储一个离线消息段落
+        """存储一个群的全部离线消息段落（单个事务内批量写入）
+        
+        按内容哈希去重时，消息ID已存在的消息仍会被跳过；
+        标记消息同样按ID检查，已存在的标记不会重复写入。
+        入队的ID会加入 existing_message_ids，以过滤本批次内的重复。
         
         Returns:
             成功存储的消息数（包含标记消息）
         """
-        if not segment_messages:
-            return 0
+        rows_source: List[Tuple[List[SyncedMessage], bool, bool]] = []
+        for segment_messages in segments:
+            fresh: List[SyncedMessage] = []
+            for msg_data in segment_messages:
+                if msg_data.msg_id in existing_message_ids:
+                    continue
+                existing_message_ids.add(msg_data.msg_id)
+                fresh.append(msg_data)
+            if not fresh:
+                continue
             
-        synced = 0
-        first_msg = segment_messages[0]
-        last_msg = segment_messages[-1]
+            add_start = add_end = False
+            if add_markers:
+                start_id = self._marker_message_id("start", fresh[0].msg_time - 0.1)
+                end_id = self._marker_message_id("end", fresh[-1].msg_time + 0.1)
+                add_start = start_id not in existing_message_ids
+                add_end = end_id not in existing_message_ids
+                existing_message_ids.update((start_id, end_id))
+            rows_source.append((fresh, add_start, add_end))
+        
+        if not rows_source:
+            return 0
         
-        if add_markers:
-            success = await self._store_marker_message(
+        try:
+            return await asyncio.to_thread(
+                self._write_group_sync,
+                stream_id,
+                group_id,
+                rows_source,
+            )
+        except Exception as e:
+            logger.error(f"[麦上号] 存储离线消息失败: {e}", exc_info=True)
+            return 0
+
+    def _build_segment_rows(
+        self,
+        stream_id: str,
+        group_id: str,
+        segment_messages: List[SyncedMessage],
+        add_start: bool,
+        add_end: bool,
+        current_time: float,
+    ) -> List[Dict[str, Any]]:
+        """构造一个段落的全部待写入行"""
+        bot_qq = str(global_config.bot.qq_account)
+        bot_name = global_config.bot.nickname
+        
+        rows: List[Dict[str, Any]] = []
+        if add_start:
+            rows.append(self._build_marker_row(
                 stream_id=stream_id,
                 group_id=group_id,
-                msg_time=first_msg["msg_time"] - 0.1,
+                msg_time=segment_messages[0].msg_time - 0.1,
                 marker_type="start",
-            )
-            if success:
-                synced += 1
+                bot_qq=bot_qq,
+                bot_name=bot_name,
+                current_time=current_time,
+            ))
         
         for msg_data in segment_messages:
-            success = await self._store_message(
+            rows.append(self._build_message_row(
                 stream_id=stream_id,
                 group_id=group_id,
-                msg_id=msg_data["msg_id"],
-                msg_time=msg_data["msg_time"],
-                sender_id=msg_data["sender_id"],
-                sender_name=msg_data["sender_name"],
-                sender_card=msg_data["sender_card"],
-                content=msg_data["content"],
-            )
-            if success:
-                synced += 1
+                msg_data=msg_data,
+                current_time=current_time,
+            ))
         
-        if add_markers:
-            success = await self._store_marker_message(
+        if add_end:
+            rows.append(self._build_marker_row(
                 stream_id=stream_id,
                 group_id=group_id,
-                msg_time=last_msg["msg_time"] + 0.1,
+                msg_time=segment_messages[-1].msg_time + 0.1,
                 marker_type="end",
-            )
-            if success:
-                synced += 1
+                bot_qq=bot_qq,
+                bot_name=bot_name,
+                current_time=current_time,
+            ))
+        return rows
+
+    def _ensure_chat_stream(
+        self,
+        stream_id: str,
+        group_id: str,
+        first_msg: SyncedMessage,
+        current_time: float,
+    ) -> None:
+        """确保聊天流记录存在，每次同步每个群只检查一次
         
-        return synced
+        使用 get_or_create：若 MaiBot 核心在同一时刻创建了该聊天流，
+        插入冲突后会回退为读取已有记录，而不是抛出异常。
+        """
+        ChatStreams.get_or_create(
+            stream_id=stream_id,
+            defaults={
+                "platform": "qq",
+                "group_platform": "qq",
+                "group_id": group_id,
+                "group_name": "",
+                "user_platform": "qq",
+                "user_id": first_msg.sender_id,
+                "user_nickname": first_msg.sender_name,
+                "user_cardname": first_msg.sender_card,
+                "create_time": float(first_msg.msg_time),
+                "last_active_time": current_time,
+            },
+        )
 
-    async def _store_marker_message(
+    def _write_group_sync(
         self,
         stream_id: str,
         group_id: str,
-        msg_time: float,
-        marker_type: str,
-    ) -> bool:
-        """存储离线消息标记"""
-        try:
-            bot_qq = str(global_config.bot.qq_account)
-            bot_name = global_config.bot.nickname
+        segments: List[Tuple[List[SyncedMessage], bool, bool]],
+    ) -> int:
+        """在一个线程、一个事务中完成一个群的全部写入（在线程中执行）
+        
+        依次确保聊天流存在、构造并写入全部消息行、更新聊天流活跃时间。
+        活跃时间在拿到写锁后取一次，整个群的写入共用。
+        
+        Returns:
+            实际写入的行数
+        """
+        database = Messages._meta.database
+        self._tune_sqlite_connection(database)
+        
+        # 多个群并发写入：SQLite 下用 IMMEDIATE 事务在开始时就拿写锁，
+        # 否则先读后写的 DEFERRED 事务升级写锁时会直接报 database is locked，
+        # 而不会等待 busy timeout
+        if isinstance(database, SqliteDatabase):
+            transaction = database.atomic("IMMEDIATE")
+        else:
+            transaction = database.atomic()
+        
+        with transaction:
+            current_time = time.time()
+            try:
+                self._ensure_chat_stream(stream_id, group_id, segments[0][0][0], current_time)
+            except Exception as e:
+                logger.warning(f"[麦上号] 创建聊天流失败: {e}")
             
-            if marker_type == "start":
-                marker_text = OFFLINE_MESSAGE_START
-                msg_id = f"offline_marker_start_{int(msg_time * 1000)}"
-            else:
-                marker_text = OFFLINE_MESSAGE_END
-                msg_id = f"offline_marker_end_{int(msg_time * 1000)}"
+            rows: List[Dict[str, Any]] = []
+            for segment_messages, add_start, add_end in segments:
+                rows.extend(self._build_segment_rows(
+                    stream_id, group_id, segment_messages, add_start, add_end, current_time
+                ))
             
-            current_time = time.time()
-
-            def _db_operation():
+            # 原始 INSERT 不会经过 peewee 的 Python 端默认值，
+            # 这里为行构造器未设置的字段补上模型声明的 default
+            missing_defaults = [
+                (field.name, default)
+                for field, default in Messages._meta.defaults.items()
+                if field.name not in rows[0]
+            ]
+            for row in rows:
+                for name, default in missing_defaults:
+                    row[name] = default() if callable(default) else default
+            
+            columns = tuple(rows[0])
+            converters = [Messages._meta.fields[c].db_value for c in columns]
+            batch_size = max(1, SQLITE_MAX_VARIABLES // len(columns))
+            inserted = 0
+            for batch in chunked(rows, batch_size):
+                params = [
+                    convert(row[c])
+                    for row in batch
+                    for c, convert in zip(columns, converters)
+                ]
+                cursor = database.execute_sql(
+                    _messages_insert_sql(columns, len(batch)), params
+                )
+                inserted += cursor.rowcount
+            
+            if inserted:
                 try:
-                    chat_stream = ChatStreams.get_or_none(
+                    ChatStreams.update(last_active_time=current_time).where(
                         ChatStreams.stream_id == stream_id
-                    )
-                    if not chat_stream:
-                        chat_stream = ChatStreams.create(
-                            stream_id=stream_id,
-                            platform="qq",
-                            group_platform="qq",
-                            group_id=group_id,
-                            group_name="",
-                            user_platform="qq",
-                            user_id=bot_qq,
-                            user_nickname=bot_name,
-                            user_cardname="",
-                            create_time=msg_time,
-                            last_active_time=current_time,
-                        )
-                    else:
-                        chat_stream.last_active_time = current_time
-                        chat_stream.save()
+                    ).execute()
                 except Exception as e:
                     logger.warning(f"[麦上号] 更新聊天流失败: {e}")
+        
+        return inserted
 
-                existing = Messages.get_or_none(Messages.message_id == msg_id)
-                if existing:
-                    return False
-
-                Messages.create(
-                    message_id=msg_id,
-                    time=float(msg_time),
-                    chat_id=stream_id,
-                    reply_to="",
-                    interest_value=0,
-                    key_words="",
-                    key_words_lite="",
-                    is_mentioned=False,
-                    is_at=False,
-                    reply_probability_boost=0.0,
-                    chat_info_stream_id=stream_id,
-                    chat_info_platform="qq",
-                    chat_info_user_platform="qq",
-                    chat_info_user_id=bot_qq,
-                    chat_info_user_nickname=bot_name,
-                    chat_info_user_cardname="",
-                    chat_info_group_platform="qq",
-                    chat_info_group_id=group_id,
-                    chat_info_group_name="",
-                    chat_info_create_time=msg_time,
-                    chat_info_last_active_time=current_time,
-                    user_platform="qq",
-                    user_id=bot_qq,
-                    user_nickname=bot_name,
-                    user_cardname="",
-                    processed_plain_text="",
-                    display_message=marker_text,
-                    priority_mode="",
-                    priority_info="",
-                    is_emoji=False,
-                    is_picid=False,
-                    is_command=False,
-                    intercept_message_level=0,
-                    is_notify=False,
-                    selected_expressions="",
-                )
-                return True
-
-            result = await asyncio.to_thread(_db_operation)
-            if result:
-                logger.debug(f"[麦上号] 存储标记消息: {marker_text}")
-            return result
+    @classmethod
+    def _tune_sqlite_connection(cls, database):
+        """为同步写入调整当前线程连接的 SQLite 参数（必须在事务外调用）
+        
+        synchronous / temp_store 是连接级参数，对当前线程的连接生效。
+        synchronous 只会从 FULL/EXTRA 降到 NORMAL，不会覆盖宿主更激进的设置。
+        journal_mode=WAL 会持久化到数据库文件，由 _ensure_sync_indexes 在并发写入前设置一次。
+        """
+        if not isinstance(database, SqliteDatabase):
+            return
+        try:
+            synchronous = database.execute_sql("PRAGMA synchronous").fetchone()[0]
+            if synchronous > 1:
+                database.execute_sql("PRAGMA synchronous=NORMAL")
+            database.execute_sql("PRAGMA temp_store=MEMORY")
+        except Exception as e:
+            logger.warning(f"[麦上号] 调整数据库参数失败: {e}")
 
+    @classmethod
+    def _ensure_sync_indexes(cls, database):
+        """各群并发同步前的一次性数据库准备（仅首次执行）
+        
+        先将数据库切换为 WAL 模式，再建立复合索引：
+        (chat_id, message_id) 覆盖按消息ID去重的 IN 查询，
+        (chat_id, time) 覆盖按时间窗口拉取内容哈希的范围查询。
+        """
+        if not isinstance(database, SqliteDatabase):
+            return
+        
+        if not cls._sqlite_wal_enabled:
+            try:
+                journal_mode = database.execute_sql("PRAGMA journal_mode").fetchone()[0]
+                if str(journal_mode).lower() != "wal":
+                    # PRAGMA 返回切换后的实际模式，其他连接持有事务或内存数据库时不会切换成功
+                    journal_mode = database.execute_sql("PRAGMA journal_mode=WAL").fetchone()[0]
+                    if str(journal_mode).lower() == "wal":
+                        logger.info("[麦上号] 已将数据库切换为 WAL 模式")
+                if str(journal_mode).lower() == "wal":
+                    cls._sqlite_wal_enabled = True
+                else:
+                    logger.warning(f"[麦上号] 切换 WAL 模式失败，当前模式: {journal_mode}")
+            except Exception as e:
+                logger.warning(f"[麦上号] 切换 WAL 模式失败: {e}")
+        
+        if cls._sync_indexes_ready:
+            return
+        table = Messages._meta.table_name
+        try:
+            database.execute_sql(
+                f'CREATE INDEX IF NOT EXISTS "idx_{table}_chat_msgid" '
+                f'ON "{table}" (chat_id, message_id)'
+            )
+            database.execute_sql(
+                f'CREATE INDEX IF NOT EXISTS "idx_{table}_chat_time" '
+                f'ON "{table}" (chat_id, time)'
+            )
+            cls._sync_indexes_ready = True
         except Exception as e:
-            logger.error(f"[麦上号] 存储标记消息失败: {e}", exc_info=True)
-            return False
+            logger.warning(f"[麦上号] 创建同步索引失败: {e}")
+
+    @staticmethod
+    def _marker_message_id(marker_type: str, msg_time: float) -> str:
+        """生成离线消息标记的ID（start / end）"""
+        return f"offline_marker_{marker_type}_{int(msg_time * 1000)}"
+
+    def _build_marker_row(
+        self,
+        stream_id: str,
+        group_id: str,
+        msg_time: float,
+        marker_type: str,
+        bot_qq: str,
+        bot_name: str,
+        current_time: float,
+    ) -> Dict[str, Any]:
+        """构造离线消息标记行"""
+        if marker_type == "start":
+            marker_text = OFFLINE_MESSAGE_START
+        else:
+            marker_text = OFFLINE_MESSAGE_END
+        msg_id = self._marker_message_id(marker_type, msg_time)
+        
+        return {
+            **_BASE_MSG_DEFAULTS,
+            "message_id": msg_id,
+            "time": float(msg_time),
+            "chat_id": stream_id,
+            "chat_info_stream_id": stream_id,
+            "chat_info_user_id": bot_qq,
+            "chat_info_user_nickname": bot_name,
+            "chat_info_user_cardname": "",
+            "chat_info_group_id": group_id,
+            "chat_info_create_time": msg_time,
+            "chat_info_last_active_time": current_time,
+            "user_id": bot_qq,
+            "user_nickname": bot_name,
+            "user_cardname": "",
+            "processed_plain_text": "",
+            "display_message": marker_text,
+        }
+
+    def _build_message_row(
+        self,
+        stream_id: str,
+        group_id: str,
+        msg_data: SyncedMessage,
+        current_time: float,
+    ) -> Dict[str, Any]:
+        """构造普通消息行"""
+        msg_id, msg_time, sender_id, sender_name, sender_card, content = msg_data
+        
+        return {
+            **_BASE_MSG_DEFAULTS,
+            "message_id": msg_id,
+            "time": float(msg_time),
+            "chat_id": stream_id,
+            "chat_info_stream_id": stream_id,
+            "chat_info_user_id": sender_id,
+            "chat_info_user_nickname": sender_name,
+            "chat_info_user_cardname": sender_card,
+            "chat_info_group_id": group_id,
+            "chat_info_create_time": msg_time,
+            "chat_info_last_active_time": current_time,
+            "user_id": sender_id,
+            "user_nickname": sender_name,
+            "user_cardname": sender_card,
+            "processed_plain_text": content,
+            "display_message": "",
+        }
 
     async def _trigger_planner_for_groups(self, groups_info: List[Dict[str, Any]]):
         """为同步的群触发 planner"""
@@ -1148,6 +1761,11 @@ class MaiShangHaoHandler(BaseEventHandler):
             from src.chat.message_receive.message import MessageRecv
             from maim_message import UserInfo, GroupInfo, BaseMessageInfo, Seg
             
+            chat_manager = get_chat_manager()
+            
+            targets: List[Dict[str, Any]] = []
+            
+            # 设置消息上下文只是内存操作，先同步完成
             for group_info in groups_info:
                 stream_id = group_info["stream_id"]
                 group_id = group_info["group_id"]
@@ -1159,7 +1777,6 @@ class MaiShangHaoHandler(BaseEventHandler):
                 logger.info(f"[麦上号] 为群 {group_id} 触发 planner...")
                 
                 try:
-                    chat_manager = get_chat_manager()
                     chat_stream = chat_manager.get_stream(stream_id)
                     
                     if chat_stream and chat_stream.context is None:
@@ -1197,189 +1814,115 @@ class MaiShangHaoHandler(BaseEventHandler):
                         fake_message = MessageRecv(message_dict)
                         chat_stream.set_context(fake_message)
                         logger.debug(f"[麦上号] 已为群 {group_id} 设置消息上下文")
-                    
-                    chat_instance = await heartflow.get_or_create_heartflow_chat(stream_id)
-                    
-                    if chat_instance and isinstance(chat_instance, HeartFChatting):
-                        chat_instance.last_read_time = latest_msg["time"] - 1
-                        logger.info(
-                            f"[麦上号] 已更新群 {group_id} 的读取时间戳，"
-                            f"心流循环将自动处理新消息"
-                        )
-                    else:
-                        logger.warning(
-                            f"[麦上号] 群 {group_id} 的聊天实例创建失败或类型不正确"
-                        )
-                        
                 except Exception as e:
                     logger.error(f"[麦上号] 触发群 {group_id} 的 planner 失败: {e}")
-                    
-                await asyncio.sleep(0.5)
-                    
-        except ImportError as e:
-            logger.error(f"[麦上号] 导入心流模块失败: {e}")
-        except Exception as e:
-            logger.error(f"[麦上号] 触发 planner 失败: {e}", exc_info=True)
-
-    async def _get_existing_message_ids(self, stream_id: str) -> Set[str]:
-        """获取数据库中已存在的消息ID集合"""
-        try:
-            messages = await asyncio.to_thread(
-                lambda: list(
-                    Messages.select(Messages.message_id)
-                    .where(Messages.chat_id == stream_id)
-                    .execute()
-                )
+                    continue
+                
+                targets.append(group_info)
+            
+            planner_semaphore = asyncio.Semaphore(PLANNER_MAX_CONCURRENCY)
+            
+            async def _get_chat(stream_id: str):
+                async with planner_semaphore:
+                    return await heartflow.get_or_create_heartflow_chat(stream_id)
+            
+            chat_instances = await asyncio.gather(
+                *[_get_chat(g["stream_id"]) for g in targets], return_exceptions=True
             )
-            return {msg.message_id for msg in messages if msg.message_id}
-        except Exception as e:
-            logger.error(f"[麦上号] 获取已存在消息ID失败: {e}")
-            return set()
-
-    async def _get_existing_message_hashes(self, stream_id: str) -> Set[str]:
-        """获取数据库中已存在的消息内容哈希集合"""
-        try:
-            messages = await asyncio.to_thread(
-                lambda: list(
-                    Messages.select(
-                        Messages.user_id,
-                        Messages.time,
-                        Messages.processed_plain_text,
+            
+            for group_info, chat_instance in zip(targets, chat_instances):
+                group_id = group_info["group_id"]
+                if isinstance(chat_instance, BaseException):
+                    logger.error(
+                        f"[麦上号] 触发群 {group_id} 的 planner 失败: {chat_instance}"
                     )
-                    .where(Messages.chat_id == stream_id)
-                    .execute()
-                )
-            )
-            hashes = set()
-            for msg in messages:
-                if msg.user_id and msg.time and msg.processed_plain_text:
-                    hash_val = self._generate_content_hash(
-                        msg.user_id, msg.time, msg.processed_plain_text
+                elif chat_instance and isinstance(chat_instance, HeartFChatting):
+                    chat_instance.last_read_time = group_info["latest_message"]["time"] - 1
+                    logger.info(
+                        f"[麦上号] 已更新群 {group_id} 的读取时间戳，"
+                        f"心流循环将自动处理新消息"
                     )
-                    hashes.add(hash_val)
-            return hashes
+                else:
+                    logger.warning(
+                        f"[麦上号] 群 {group_id} 的聊天实例创建失败或类型不正确"
+                    )
+
+        except ImportError as e:
+            logger.error(f"[麦上号] 导入心流模块失败: {e}")
         except Exception as e:
-            logger.error(f"[麦上号] 获取已存在消息哈希失败: {e}")
-            return set()
+            logger.error(f"[麦上号] 触发 planner 失败: {e}", exc_info=True)
 
-    async def _get_existing_message_times(self, stream_id: str) -> Set[float]:
-        """获取数据库中已存在的消息时间戳集合"""
+    async def _get_existing_dedupe_state(
+        self,
+        stream_id: str,
+        candidate_ids: List[str],
+        min_time: float,
+        max_time: float,
+        dedupe_mode: str,
+    ) -> Tuple[Set[str], Set[int]]:
+        """一次查询获取本批次的去重依据
+        
+        message_id 模式只查询 chat_id = ? AND message_id IN (...)；
+        content_hash 模式额外加上 OR time BETWEEN ? AND ?，并取出计算哈希所需的列。
+        哈希按整秒取时间，因此时间窗口两端各放宽 1 秒。
+        
+        Returns:
+            (已存在的消息ID集合, 已存在的内容哈希集合)
+        """
+        want_hashes = dedupe_mode == "content_hash"
+        if not want_hashes and not candidate_ids:
+            return set(), set()
+        
+        columns = [Messages.message_id]
+        if want_hashes:
+            columns += [
+                Messages.user_id,
+                Messages.time,
+                fn.SUBSTR(Messages.processed_plain_text, 1, CONTENT_HASH_PREFIX)
+                .alias("text_prefix"),
+            ]
+        in_window = Messages.time.between(min_time - 1, max_time + 1)
+        
+        def _query() -> Tuple[Set[str], Set[int]]:
+            ids: Set[str] = set()
+            hashes: Set[int] = set()
+            # 时间窗口条件只需要随第一组 ID 查询一次
+            id_chunks = list(chunked(candidate_ids, SQLITE_IN_CHUNK)) or [[]]
+            for i, id_chunk in enumerate(id_chunks):
+                predicate = Messages.message_id.in_(id_chunk) if id_chunk else None
+                if i == 0 and want_hashes:
+                    predicate = in_window if predicate is None else (predicate | in_window)
+                query = Messages.select(*columns).where(
+                    (Messages.chat_id == stream_id) & predicate
+                ).tuples()
+                if want_hashes:
+                    for message_id, user_id, msg_time, text_prefix in query.iterator():
+                        if message_id:
+                            ids.add(message_id)
+                        if user_id and msg_time and text_prefix:
+                            hashes.add(self._generate_content_hash(
+                                user_id, msg_time, text_prefix
+                            ))
+                else:
+                    ids.update(row[0] for row in query.iterator() if row[0])
+            return ids, hashes
+        
         try:
-            messages = await asyncio.to_thread(
-                lambda: list(
-                    Messages.select(Messages.time)
-                    .where(Messages.chat_id == stream_id)
-                    .execute()
-                )
-            )
-            return {msg.time for msg in messages if msg.time}
+            return await asyncio.to_thread(_query)
         except Exception as e:
-            logger.error(f"[麦上号] 获取已存在消息时间戳失败: {e}")
-            return set()
+            logger.error(f"[麦上号] 获取已存在消息失败: {e}")
+            return set(), set()
 
     def _generate_stream_id(self, platform: str, group_id: str) -> str:
         """生成聊天流ID（与 MaiBot 核心逻辑一致）"""
-        components = [platform, str(group_id)]
-        key = "_".join(components)
-        return hashlib.md5(key.encode()).hexdigest()
+        return _stream_id(platform, str(group_id))
 
     def _generate_content_hash(
         self, sender_id: str, msg_time: float, content: str
-    ) -> str:
+    ) -> int:
         """生成消息内容哈希，用于去重"""
-        key = f"{sender_id}_{int(msg_time)}_{content[:100]}"
-        return hashlib.md5(key.encode()).hexdigest()
-
-    async def _store_message(
-        self,
-        stream_id: str,
-        group_id: str,
-        msg_id: str,
-        msg_time: float,
-        sender_id: str,
-        sender_name: str,
-        sender_card: str,
-        content: str,
-    ) -> bool:
-        """存储消息到数据库"""
-        try:
-            current_time = time.time()
-
-            def _db_operation():
-                try:
-                    chat_stream = ChatStreams.get_or_none(
-                        ChatStreams.stream_id == stream_id
-                    )
-                    if not chat_stream:
-                        chat_stream = ChatStreams.create(
-                            stream_id=stream_id,
-                            platform="qq",
-                            group_platform="qq",
-                            group_id=group_id,
-                            group_name="",
-                            user_platform="qq",
-                            user_id=sender_id,
-                            user_nickname=sender_name,
-                            user_cardname=sender_card,
-                            create_time=msg_time,
-                            last_active_time=current_time,
-                        )
-                    else:
-                        chat_stream.last_active_time = current_time
-                        chat_stream.save()
-                except Exception as e:
-                    logger.warning(f"[麦上号] 更新聊天流失败: {e}")
-
-                if msg_id:
-                    existing = Messages.get_or_none(Messages.message_id == msg_id)
-                    if existing:
-                        return False
-
-                Messages.create(
-                    message_id=msg_id or f"sync_{int(msg_time * 1000)}_{sender_id}",
-                    time=float(msg_time),
-                    chat_id=stream_id,
-                    reply_to="",
-                    interest_value=0,
-                    key_words="",
-                    key_words_lite="",
-                    is_mentioned=False,
-                    is_at=False,
-                    reply_probability_boost=0.0,
-                    chat_info_stream_id=stream_id,
-                    chat_info_platform="qq",
-                    chat_info_user_platform="qq",
-                    chat_info_user_id=sender_id,
-                    chat_info_user_nickname=sender_name,
-                    chat_info_user_cardname=sender_card,
-                    chat_info_group_platform="qq",
-                    chat_info_group_id=group_id,
-                    chat_info_group_name="",
-                    chat_info_create_time=msg_time,
-                    chat_info_last_active_time=current_time,
-                    user_platform="qq",
-                    user_id=sender_id,
-                    user_nickname=sender_name,
-                    user_cardname=sender_card,
-                    processed_plain_text=content,
-                    display_message="",
-                    priority_mode="",
-                    priority_info="",
-                    is_emoji=False,
-                    is_picid=False,
-                    is_command=False,
-                    intercept_message_level=0,
-                    is_notify=False,
-                    selected_expressions="",
-                )
-                return True
-
-            result = await asyncio.to_thread(_db_operation)
-            return result
-
-        except Exception as e:
-            logger.error(f"[麦上号] 存储消息失败: {e}", exc_info=True)
-            return False
+        key = f"{sender_id}_{int(msg_time)}_{content[:CONTENT_HASH_PREFIX]}"
+        return _content_digest(key)
 
     def _extract_text(self, msg: dict) -> str:
         """从消息中提取文本内容
@@ -1395,35 +1938,27 @@ class MaiShangHaoHandler(BaseEventHandler):
             for seg in message:
                 if isinstance(seg, dict):
                     seg_type = seg.get("type", "")
-                    seg_data = seg.get("data", {})
-                    if seg_type == "text":
-                        texts.append(seg_data.get("text", ""))
-                    elif seg_type == "at":
-                        qq = seg_data.get("qq", "")
-                        texts.append(f"[AT:{qq}]")
-                    elif seg_type == "face":
-                        texts.append("[表情]")
-                    elif seg_type == "image":
-                        texts.append("[图片]")
-                    elif seg_type == "record":
-                        texts.append("[语音]")
-                    elif seg_type == "video":
-                        texts.append("[视频]")
-                    elif seg_type == "reply":
-                        texts.append("[回复]")
-                    else:
+                    handler = _SEG_HANDLERS.get(seg_type)
+                    if handler is None:
                         texts.append(f"[{seg_type}]")
+                    else:
+                        seg_data = seg.get("data")
+                        if not isinstance(seg_data, dict):
+                            seg_data = _EMPTY_SEG_DATA
+                        texts.append(handler(seg_data))
             return "".join(texts)
         
         content = msg.get("content", [])
         if isinstance(content, str) and content.strip():
             return content
         if isinstance(content, list):
-            texts = []
-            for seg in content:
-                if isinstance(seg, dict) and seg.get("type") == "text":
-                    texts.append(seg.get("data", {}).get("text", ""))
-            result = "".join(texts)
+            result = "".join([
+                seg["data"].get("text", "")
+                for seg in content
+                if isinstance(seg, dict)
+                and seg.get("type") == "text"
+                and isinstance(seg.get("data"), dict)
+            ])
             if result.strip():
                 return result
         
@@ -1434,6 +1969,21 @@ class MaiShangHaoHandler(BaseEventHandler):
         return ""
 
 
+class SessionCleanupHandler(BaseEventHandler):
+    """会话清理处理器 - 停止时写回配置并关闭共享的 HTTP 连接池"""
+
+    event_type = EventType.ON_STOP
+    handler_name = "mai_shang_hao_session_cleanup"
+    handler_description = "停止时写回待保存的配置并关闭 NapCat HTTP 连接池"
+
+    async def execute(
+        self, message=None
+    ) -> Tuple[bool, bool, Optional[str], None, None]:
+        await flush_pending_config()
+        await close_shared_session()
+        return True, True, "HTTP 连接池已关闭", None, None
+
+
 @register_plugin
 class MaiShangHaoPlugin(BasePlugin):
     """麦上号 - 离线消息同步 + 做梦插件"""
@@ -1507,6 +2057,11 @@ class MaiShangHaoPlugin(BasePlugin):
                 default=True,
                 description="是否在离线消息前后添加标记，让 planner 和 replyer 识别",
             ),
+            "concurrency": ConfigField(
+                type=int,
+                default=4,
+                description="同时同步的群数量上限，避免给 NapCat 造成过大压力",
+            ),
         },
         "dream": {
             "enabled": ConfigField(
@@ -1558,4 +2113,5 @@ class MaiShangHaoPlugin(BasePlugin):
             (DreamHandler.get_handler_info(), DreamHandler),
             (DreamMessageInterceptor.get_handler_info(), DreamMessageInterceptor),
             (DreamCommand.get_command_info(), DreamCommand),
+            (SessionCleanupHandler.get_handler_info(), SessionCleanupHandler),
         ]